@@ -2,26 +2,40 @@ from __future__ import annotations
 from typing import List, Optional, Dict, cast
 import numpy as np
 np.set_printoptions(suppress=True)
-import math, functools, time, random, statistics
+import math, functools, time, random, statistics, multiprocessing
+from multiprocessing.pool import AsyncResult
 from tinygrad.helpers import DEBUG, getenv, CACHELEVEL, diskcache_get, diskcache_put, colored, Profiling
 from tinygrad.codegen.kernel import Kernel
 from tinygrad.device import Buffer, Device, CompileError
-from tinygrad.engine.search import _ensure_buffer_alloc, get_kernel_actions, _time_program
+from tinygrad.engine.search import _ensure_buffer_alloc, get_kernel_actions, _time_program, _try_compile_linearized_w_idx, _init_worker
 
 class MCTSNode:
   def __init__(self, kernel:Kernel, parent=None):
     self.kernel:Kernel = kernel
     self.t = math.inf
     self.n = 0
+    self.log_n = 0.0
     self.tm = math.inf
     self.i = -1
     self.parents: List[MCTSNode] = [parent] if parent is not None else []
     self.children: Optional[List[MCTSNode]] = None
     self.removed_children: List[MCTSNode] = []
+    self.compile_ret: Optional[AsyncResult] = None
 
+mcts_pool: Optional[multiprocessing.pool.Pool] = None
+mcts_batch: List[AsyncResult] = []
 def expand_node(node:MCTSNode):
+  global mcts_batch
   assert node.children is None
   node.children = [MCTSNode(x, node) for x in get_kernel_actions(node.kernel, include_0=False).values()]
+  # NOTE: shuffled once here, so the first unexplored child in _sample_tree is a random one
+  random.shuffle(node.children)
+  # NOTE: the children are rolled out in this order before any of them is sampled again, so compile them in the background now.
+  # the first one is rolled out next and compiled inline, and a new batch only goes out once the last one is done
+  if mcts_pool is not None and all(x.ready() for x in mcts_batch):
+    _compile_fn = functools.partial(_try_compile_linearized_w_idx, compiler=Device[node.kernel.opts.device].compiler)
+    for child in node.children[1:]: child.compile_ret = mcts_pool.apply_async(_compile_fn, ((0, child.kernel),))
+    mcts_batch = [cast(AsyncResult, child.compile_ret) for child in node.children[1:]]
 
 def remove_node(node:MCTSNode):
   for parent in node.parents:
@@ -33,21 +47,16 @@ C = math.sqrt(2)
 TEMP = 0.5
 def _sample_tree(node:MCTSNode, best_tm:float) -> MCTSNode:
   if node.children is None or len(node.children) == 0: return node
-  unexplored_children = []
-  explored_children = []
-  ucb_explored_children: List[float] = []
-  for child in node.children:
-    if child.n == 0: unexplored_children.append(child)
-    else:
-      ucb = -child.t/best_tm + C*math.sqrt(math.log(node.n)/child.n)
-      if not math.isinf(ucb):
-        explored_children.append(child)
-        ucb_explored_children.append(ucb)
-  if len(unexplored_children): return random.choice(unexplored_children)
-  if not len(explored_children): return node
-  # safe softmax
-  ucb_exp = np.exp((np.array(ucb_explored_children)-max(ucb_explored_children))/TEMP)
-  return _sample_tree(explored_children[np.random.choice(len(ucb_exp), p=ucb_exp/np.sum(ucb_exp))], best_tm)
+  # unexplored children come first, no need to score the others
+  if (unexplored:=next((child for child in node.children if child.n == 0), None)) is not None: return unexplored
+  n_arr = np.array([child.n for child in node.children], dtype=np.float64)
+  t_arr = np.array([child.t for child in node.children], dtype=np.float64)
+  # NOTE: failed children have t=inf, which is nan (not -inf) before best_tm is set
+  with np.errstate(invalid='ignore'): ucb = -t_arr/best_tm + C*np.sqrt(node.log_n/n_arr)
+  if not len(explored:=np.flatnonzero(np.isfinite(ucb))): return node
+  # safe softmax, sampled with one searchsorted over the cdf (what np.random.choice does, minus its validation of p)
+  cdf = np.cumsum(np.exp((ucb[explored]-ucb[explored].max())/TEMP))
+  return _sample_tree(node.children[explored[cdf.searchsorted(np.random.random()*cdf[-1], side='right')]], best_tm)
 
 # this will expand/remove sometimes
 def sample_tree(root:MCTSNode, best_tm:float) -> Optional[MCTSNode]:
@@ -62,23 +71,25 @@ def sample_tree(root:MCTSNode, best_tm:float) -> Optional[MCTSNode]:
 
     # node expansion
     if node.n != 0:
-      if node.children is None: expand_node(node)
+      if (expanded:=node.children is None): expand_node(node)
       assert node.children is not None
       if len(node.children) == 0:
         remove_node(node)
         continue
-      node = random.choice(node.children)
+      # NOTE: the first child of a new expansion is the random one that wasn't sent to mcts_pool
+      node = node.children[0] if expanded else random.choice(node.children)
     return node
   return None
 
 def backprop(bnode:MCTSNode, tm, strength=1.0):
   if bnode.t > tm: bnode.t = tm
   bnode.n += strength
+  bnode.log_n = math.log(bnode.n)
   for parent in bnode.parents: backprop(parent, tm, strength/len(bnode.parents))
 
 graph_mcts_cnt = 0
 def mcts_search(lin:Kernel, rawbufs:List[Buffer], amt:int) -> Kernel:
-  global graph_mcts_cnt
+  global graph_mcts_cnt, mcts_pool, mcts_batch
   # TODO: copied from BEAM
   key = {"ast": lin.ast.key, "amt": amt, "device": lin.opts.device, "suffix": lin.opts.suffix}
   if not getenv("IGNORE_MCTS_CACHE") and CACHELEVEL >= 1 and (val:=diskcache_get("mcts_search", key)) is not None:
@@ -91,61 +102,83 @@ def mcts_search(lin:Kernel, rawbufs:List[Buffer], amt:int) -> Kernel:
   dev = Device[lin.opts.device]
   root = MCTSNode(lin)
 
+  default_parallel = multiprocessing.cpu_count() if lin.opts.device in {"CUDA", "AMD", "NV", "METAL"} else 0
+  if mcts_pool is None and (workers := getenv("PARALLEL", default_parallel)):
+    mcts_pool = multiprocessing.get_context("spawn").Pool(workers, _init_worker, (), getenv("BEAM_MAX_TASKS_PER_CHILD", 16))
+
   st = time.perf_counter()
   best, best_idx, best_tm = lin, 0, math.inf
   seen_libs: Dict[bytes, MCTSNode] = {}
   seen_asts: Dict[bytes, MCTSNode] = {}
+  seen_srcs: Dict[str, Optional[bytes]] = {}
   compile_time, runtime_time = 0.0, 0.0
-  for i in range(amt):
-    node = sample_tree(root, best_tm)  # sample and expand
-    if node is None: break  # finished the whole tree
-    node.i = i  # when was node explored
-
-    opt_ast = node.kernel.get_optimized_ast()
-    if (sibling_node:=seen_asts.get(opt_ast.key, None)) is not None:
-      # early check for same optimized AST hit
-      remove_node(node)
-      tm = sibling_node.t
-    else:
-      seen_asts[opt_ast.key] = node
-
-      # lowering (50% of the time)
-      p = node.kernel.to_program(name_override="test")
-
-      # rollout
-      tm1 = time.perf_counter()
-      try:
-        lib = dev.compiler.compile(p.src)
-      except CompileError:
-        # NOTE: many of these "compiler errors" are caused by bad code output from the lowerer
-        lib = None
-      tm2 = time.perf_counter()
-      if lib is None:
-        tm = math.inf
+  try:
+    for i in range(amt):
+      node = sample_tree(root, best_tm)  # sample and expand
+      if node is None: break  # finished the whole tree
+      node.i = i  # when was node explored
+
+      opt_ast = node.kernel.get_optimized_ast()
+      if (sibling_node:=seen_asts.get(opt_ast.key, None)) is not None:
+        # early check for same optimized AST hit
+        remove_node(node)
+        tm = sibling_node.t
       else:
-        if (sibling_node:=seen_libs.get(lib, None)) is not None:
-          # NOTE: these should all be caught by the AST check, need to canonicalize
-          # remove this node, it's a duplicate
-          remove_node(node)
-          tm = sibling_node.t
+        seen_asts[opt_ast.key] = node
+
+        if node.compile_ret is not None:
+          # lowered and compiled in mcts_pool when the parent was expanded
+          tm1 = time.perf_counter()
+          if (ret:=node.compile_ret.get()[1]) is not None: p, lib = ret[0], seen_srcs.setdefault(ret[0].src, ret[1])
+          else: p, lib = None, None
+        else:
+          # lowering (50% of the time)
+          p = node.kernel.to_program(name_override="test")
+
+          # rollout
+          tm1 = time.perf_counter()
+          # NOTE: different optimized ASTs can still render to the same source, don't compile it again
+          if p.src in seen_srcs: lib = seen_srcs[p.src]
+          else:
+            try:
+              lib = dev.compiler.compile(p.src)
+            except CompileError:
+              # NOTE: many of these "compiler errors" are caused by bad code output from the lowerer
+              lib = None
+            seen_srcs[p.src] = lib
+        tm2 = time.perf_counter()
+        if lib is None:
+          tm = math.inf
         else:
-          seen_libs[lib] = node
-          try: tm = statistics.median(_time_program(p, lib, var_vals, rawbufs, cnt=3, early_stop=best_tm*5/1e6))*1e6
-          except RuntimeError: tm = math.inf
-          node.tm = tm
-      tm3 = time.perf_counter()
-      compile_time += tm2-tm1
-      runtime_time += tm3-tm2
-
-      # mock rollout
-      #node.tm = tm = random.random() + 0.1
-
-    if tm < best_tm: best, best_idx, best_tm = node.kernel, i, tm
-    et = time.perf_counter() - st
-    if DEBUG>=2: print(f"\r{et:7.2f}s {colored(f'{compile_time*100/et:3.0f}%', 'cyan')} {colored(f'{runtime_time*100/et:3.0f}%', 'red')}: {tm:12.2f} us     best: {best_tm:12.2f} us @ {best_idx+1:4d}      {i+1:4d}/{amt:4d}  {int(round((i+1)/et)):4d}/s     {node.kernel.colored_shape()}\033[K", end="")  # noqa: E501
-
-    # backprop
-    backprop(node, tm)
+          if (sibling_node:=seen_libs.get(lib, None)) is not None:
+            # NOTE: these should all be caught by the AST check, need to canonicalize
+            # remove this node, it's a duplicate
+            remove_node(node)
+            tm = sibling_node.t
+          else:
+            seen_libs[lib] = node
+            try: tm = statistics.median(_time_program(p, lib, var_vals, rawbufs, cnt=3, early_stop=best_tm*5/1e6))*1e6
+            except RuntimeError: tm = math.inf
+            node.tm = tm
+        tm3 = time.perf_counter()
+        compile_time += tm2-tm1
+        runtime_time += tm3-tm2
+
+        # mock rollout
+        #node.tm = tm = random.random() + 0.1
+
+      if tm < best_tm: best, best_idx, best_tm = node.kernel, i, tm
+      et = time.perf_counter() - st
+      if DEBUG>=2: print(f"\r{et:7.2f}s {colored(f'{compile_time*100/et:3.0f}%', 'cyan')} {colored(f'{runtime_time*100/et:3.0f}%', 'red')}: {tm:12.2f} us     best: {best_tm:12.2f} us @ {best_idx+1:4d}      {i+1:4d}/{amt:4d}  {int(round((i+1)/et)):4d}/s     {node.kernel.colored_shape()}\033[K", end="")  # noqa: E501
+
+      # backprop
+      backprop(node, tm)
+  except KeyboardInterrupt as e:
+    if mcts_pool is not None: mcts_pool.terminate()
+    mcts_pool, mcts_batch = None, []
+    raise e
+  # NOTE: the compiles of children that were never rolled out are stale, the ones still running keep the next search from queueing behind them
+  mcts_batch = [x for x in mcts_batch if not x.ready()]
   if DEBUG>=2: print()
 
   if getenv("MCTSGRAPH"):
@@ -1,10 +1,13 @@
 from typing import Dict, List, Optional
-import unittest, decimal, json
+import unittest, decimal, json, os, threading, urllib.request, urllib.error
+from http.server import HTTPServer
+from dataclasses import asdict, replace
 from tinygrad.dtype import dtypes
 from tinygrad.ops import TRACK_MATCH_STATS, TrackedPatternMatcher as PatternMatcher, UOp, Ops, UPat, graph_rewrite, track_rewrites, symbolic
-from tinygrad.ops import tracked_ctxs as contexts, tracked_keys as keys
+from tinygrad.ops import tracked_ctxs as contexts, tracked_keys as keys, TrackedGraphRewrite
 from tinygrad.device import ProfileDeviceEvent, ProfileRangeEvent, ProfileGraphEvent, ProfileGraphEntry
-from tinygrad.viz.serve import get_details, get_metadata, uop_to_json, to_perfetto
+import tinygrad.viz.serve as viz_serve
+from tinygrad.viz.serve import GraphRewriteMetadata, Handler, get_details, get_details_json, get_metadata, uop_to_json, to_perfetto
 
 @track_rewrites(named=True)
 def rewrite(sink:UOp, pm:PatternMatcher, **kwargs): return graph_rewrite(sink, pm, **kwargs)
@@ -59,6 +62,30 @@ class TestViz(unittest.TestCase):
     self.assertEqual(len(uops), 2)
     self.assertEqual(uops[-1], graph_rewrite(a+b, pm, {}))
 
+  def test_details_json(self):
+    pm = PatternMatcher([
+      (UPat.var("x")+UPat.var("x"), lambda x:x*2),
+      (UPat.var("x", dtypes.int)*2, lambda x:x.alu(Ops.SHL, UOp.const(dtypes.int, 1))),
+    ])
+    a = UOp(Ops.LOAD, dtypes.int, (UOp(Ops.DEFINE_GLOBAL, dtypes.int.ptr(), (), 0), UOp.const(dtypes.int, 0)))
+    rewrite(a+a, pm)
+    viz_serve.kernels = get_metadata(keys, contexts)
+    get_details_json.cache_clear()
+    # NOTE: g keeps the UOps alive so both sides see the same UOp ids
+    g = get_details(*viz_serve.kernels[0][0])
+    ret = get_details_json(0, 0)
+    self.assertEqual(json.loads(ret), json.loads(json.dumps({**asdict(replace(g, uops=[])), "uops":[str(x) for x in g.uops]})))
+
+  # NOTE: graph_rewrite can't pickle a graph this deep, the context is built with UOps instead of the pickled snapshots
+  def test_deep_chain(self):
+    a = UOp(Ops.LOAD, dtypes.int, (UOp(Ops.DEFINE_GLOBAL, dtypes.int.ptr(), (), 0), UOp.const(dtypes.int, 0)))
+    sink = a*1
+    for _ in range(5000): sink = sink+1
+    ctx = TrackedGraphRewrite(("", 0), sink, [(a*1, a, None, 0.)])
+    g = get_details(None, ctx, GraphRewriteMetadata(("", 0), "", "", []))
+    self.assertEqual(len(g.uops), 2)
+    self.assertEqual(g.uops[1], sink.substitute({a*1:a}))
+
   def test_track_rewrites(self):
     simple = PatternMatcher([(UPat.var("x")*1, lambda x:x)])
     @track_rewrites(named=True)
@@ -139,6 +166,27 @@ class TestViz(unittest.TestCase):
     self.assertEqual(lineno, inner_rewrite.__code__.co_firstlineno)
     self.assertEqual(fp, inner_rewrite.__code__.co_filename)
 
+class TestVizHandler(unittest.TestCase):
+  def setUp(self):
+    self.server = HTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=self.server.serve_forever, daemon=True).start()
+    self.url = f"http://127.0.0.1:{self.server.server_port}"
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def test_asset(self):
+    with open(os.path.join(os.path.dirname(viz_serve.__file__), "assets/d3js.org/d3.v5.min.js"), "rb") as f: data = f.read()
+    with urllib.request.urlopen(f"{self.url}/assets/d3js.org/d3.v5.min.js") as r:
+      self.assertEqual(r.headers["Content-Type"], "application/javascript")
+      self.assertEqual(r.read(), data)
+
+  def test_asset_not_found(self):
+    for path in ["/assets/d3js.org/nope.js", "/assets/d3js.org/"]:
+      with self.assertRaises(urllib.error.HTTPError) as e: urllib.request.urlopen(f"{self.url}{path}")
+      self.assertEqual(e.exception.code, 404)
+      e.exception.close()
+
 class TextVizProfiler(unittest.TestCase):
   def test_perfetto_node(self):
     prof = [ProfileRangeEvent(device='NV', name='E_2', st=decimal.Decimal(1000), en=decimal.Decimal(1010), is_copy=False),
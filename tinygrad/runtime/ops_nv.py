@@ -219,9 +219,9 @@ class NVProgram(HCQProgram):
     # Apply relocs
     for apply_image_offset, rel_sym_offset, typ, _ in relocs:
       # These types are CUDA-specific, applying them here
-      if typ == 2: image[apply_image_offset:apply_image_offset+8] = struct.pack('<Q', self.lib_gpu.va_addr + rel_sym_offset) # R_CUDA_64
-      elif typ == 0x38: image[apply_image_offset+4:apply_image_offset+8] = struct.pack('<I', (self.lib_gpu.va_addr + rel_sym_offset) & 0xffffffff)
-      elif typ == 0x39: image[apply_image_offset+4:apply_image_offset+8] = struct.pack('<I', (self.lib_gpu.va_addr + rel_sym_offset) >> 32)
+      if typ == 2: struct.pack_into('<Q', image, apply_image_offset, self.lib_gpu.va_addr + rel_sym_offset) # R_CUDA_64
+      elif typ == 0x38: struct.pack_into('<I', image, apply_image_offset+4, (self.lib_gpu.va_addr + rel_sym_offset) & 0xffffffff)
+      elif typ == 0x39: struct.pack_into('<I', image, apply_image_offset+4, (self.lib_gpu.va_addr + rel_sym_offset) >> 32)
       else: raise RuntimeError(f"unknown NV reloc {typ}")
 
     ctypes.memmove(self.lib_gpu.va_addr, mv_address(image), image.nbytes)
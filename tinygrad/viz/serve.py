@@ -2,8 +2,8 @@
 import multiprocessing, pickle, functools, difflib, os, threading, json, time, sys, webbrowser, socket, argparse, decimal
 from http.server import HTTPServer, BaseHTTPRequestHandler
 from urllib.parse import parse_qs, urlparse
-from dataclasses import asdict, dataclass
-from typing import Any, Callable, Optional
+from dataclasses import asdict, dataclass, fields
+from typing import Any, BinaryIO, Callable, Optional
 from tinygrad.helpers import colored, getenv, to_function_name, tqdm, unwrap, word_wrap
 from tinygrad.ops import TrackedGraphRewrite, UOp, Ops, lines, GroupOp
 from tinygrad.codegen.kernel import Kernel
@@ -51,66 +51,90 @@ def pcall(fxn:Callable[..., str], *args, **kwargs) -> str:
   try: return fxn(*args, **kwargs)
   except Exception as e: return f"ERROR: {e}"
 
+# NOTE: in-process contexts can hold the UOps directly, only the ones that crossed a process boundary are pickled
+def _loads(x:bytes|UOp) -> UOp: return pickle.loads(x) if isinstance(x, (bytes, bytearray)) else x
+
 def get_metadata(keys:list[Any], contexts:list[list[TrackedGraphRewrite]]) -> list[list[tuple[Any, TrackedGraphRewrite, GraphRewriteMetadata]]]:
   kernels: dict[str, list[tuple[Any, TrackedGraphRewrite, GraphRewriteMetadata]]] = {}
   for k,ctxs in tqdm(zip(keys, contexts), desc="preparing kernels"):
     name = to_function_name(k.name) if isinstance(k, Kernel) else str(k)
     for ctx in ctxs:
-      if pickle.loads(ctx.sink).op is Ops.CONST: continue
+      if _loads(ctx.sink).op is Ops.CONST: continue
       upats = [(upat.location, upat.printable(), tm) for _,_,upat,tm in ctx.matches if upat is not None]
       kernels.setdefault(name, []).append((k, ctx, GraphRewriteMetadata(ctx.loc, lines(ctx.loc[0])[ctx.loc[1]-1].strip(), name, upats)))
   return list(kernels.values())
 
-def uop_to_json(x:UOp) -> dict[int, tuple[str, str, list[int], str, str]]:
-  assert isinstance(x, UOp)
+def uop_to_json(x:UOp, cache:Optional[dict[tuple[UOp, tuple[bool, ...]], tuple[str, str, list[int], str, str]]]=None) \
+    -> dict[int, tuple[str, str, list[int], str, str]]:
+  # NOTE: a node only depends on itself and which of its srcs are excluded, cache is shared across the sinks of one rewrite
+  if cache is None: cache = {}
   graph: dict[int, tuple[str, str, list[int], str, str]] = {}
   excluded: set[UOp] = set()
   for u in (toposort:=x.toposort):
     if u.op in {Ops.CONST, Ops.DEVICE}: excluded.update((u,) + u.src)
   for u in toposort:
     if u in excluded: continue
+    if (ret:=cache.get(key:=(u, tuple(x in excluded for x in u.src)))) is not None:
+      graph[id(u)] = ret
+      continue
     argst = str(u.arg)
+    labelst = argst
     if u.op is Ops.VIEW:
-      argst = ("\n".join([f"{v.shape} / {v.strides}"+(f" / {v.offset}" if v.offset is not None else "") for v in unwrap(u.st).views]))
-    label = f"{str(u.op).split('.')[1]}{(' '+word_wrap(argst.replace(':', ''))) if u.arg is not None else ''}\n{str(u.dtype)}"
+      labelst = ("\n".join([f"{v.shape} / {v.strides}"+(f" / {v.offset}" if v.offset is not None else "") for v in unwrap(u.st).views]))
+    label, src_ids = [f"{u.op.name}{(' '+word_wrap(labelst.replace(':', ''))) if u.arg is not None else ''}\n{(dtst:=str(u.dtype))}"], []
+    # one pass over the srcs, excluded ones go in the label instead of the edges
     for idx,x in enumerate(u.src):
-      if x in excluded:
-        if x.op is Ops.CONST and dtypes.is_float(u.dtype): label += f"\nCONST{idx} {x.arg:g}"
-        else: label += f"\n{x.op.name}{idx} {x.arg}"
-    graph[id(u)] = (label, str(u.dtype), [id(x) for x in u.src if x not in excluded], str(u.arg), uops_colors.get(u.op, "#ffffff"))
+      if x not in excluded: src_ids.append(id(x))
+      elif x.op is Ops.CONST and dtypes.is_float(u.dtype): label.append(f"CONST{idx} {x.arg:g}")
+      else: label.append(f"{x.op.name}{idx} {x.arg}")
+    graph[id(u)] = cache[key] = ("\n".join(label), dtst, src_ids, argst, uops_colors.get(u.op, "#ffffff"))
   return graph
 def _replace_uop(base:UOp, replaces:dict[UOp, UOp]) -> UOp:
-  if (found:=replaces.get(base)) is not None: return found
-  ret = base.replace(src=tuple(_replace_uop(x, replaces) for x in base.src))
-  if (final := replaces.get(ret)) is not None:
-      return final
-  replaces[base] = ret
-  return ret
+  # iterative post-order walk, replaces is also the memo of every UOp already rewritten
+  stack: list[tuple[UOp, bool]] = [(base, False)]
+  while stack:
+    u, srcs_done = stack.pop()
+    if u in replaces: continue
+    if not srcs_done:
+      stack.append((u, True))
+      stack.extend((x, False) for x in reversed(u.src) if x not in replaces)
+      continue
+    ret = u.replace(src=tuple(replaces[x] for x in u.src))
+    replaces[u] = replaces.get(ret, ret)
+  return replaces[base]
 @functools.lru_cache(None)
 def _prg(k:Kernel): return k.to_program().src
 def get_details(k:Any, ctx:TrackedGraphRewrite, metadata:GraphRewriteMetadata) -> GraphRewriteDetails:
-  g = GraphRewriteDetails(**asdict(metadata), uops=[pickle.loads(ctx.sink)], diffs=[], changed_nodes=[],
+  g = GraphRewriteDetails(**asdict(metadata), uops=[_loads(ctx.sink)], diffs=[], changed_nodes=[],
                           kernel_code=pcall(_prg, k) if isinstance(k, Kernel) else None, graphs=[])
   replaces: dict[UOp, UOp] = {}
-  g.graphs.append(uop_to_json(sink:=g.uops[0]))
+  json_cache: dict[tuple[UOp, tuple[bool, ...]], tuple[str, str, list[int], str, str]] = {}
+  g.graphs.append(uop_to_json(sink:=g.uops[0], json_cache))
   for i,(u0_b,u1_b,upat,_) in enumerate(ctx.matches):
-    u0 = pickle.loads(u0_b)
+    u0 = _loads(u0_b)
     # if the match didn't result in a rewrite we move forward
     if u1_b is None:
       replaces[u0] = u0
       continue
-    replaces[u0] = u1 = pickle.loads(u1_b)
+    replaces[u0] = u1 = _loads(u1_b)
     # first, rewrite this UOp with the current rewrite + all the matches in replaces
     new_sink = _replace_uop(sink, {**replaces})
     # sanity check
     if new_sink is sink: raise AssertionError(f"rewritten sink wasn't rewritten! {i} {unwrap(upat).location}")
     # update ret data
-    g.graphs.append(new_sink_js:=uop_to_json(new_sink))
+    g.graphs.append(new_sink_js:=uop_to_json(new_sink, json_cache))
     g.changed_nodes.append([id(x) for x in u1.toposort if id(x) in new_sink_js])
     g.diffs.append(list(difflib.unified_diff(pcall(str, u0).splitlines(), pcall(str, u1).splitlines())))
     g.uops.append(sink:=new_sink)
   return g
 
+# NOTE: VIZ requests the same details every time a rewrite is clicked in the sidebar
+@functools.lru_cache(maxsize=256)
+def get_details_json(kernel_idx:int, rewrite_idx:int) -> bytes:
+  g = get_details(*kernels[kernel_idx][rewrite_idx])
+  # NOTE: asdict would deep copy every UOp only for uops to be replaced with their str
+  return json.dumps({**{f.name:getattr(g, f.name) for f in fields(g)}, "uops": [pcall(str,x) for x in g.uops]}).encode()
+
 # Profiler API
 devices:dict[str, tuple[decimal.Decimal, decimal.Decimal, int]] = {}
 def prep_ts(device:str, ts:decimal.Decimal, is_copy): return int(decimal.Decimal(ts) + devices[device][is_copy])
@@ -145,6 +169,7 @@ def to_perfetto(profile:list[ProfileEvent]):
 class Handler(BaseHTTPRequestHandler):
   def do_GET(self):
     ret, status_code, content_type = b"", 200, "text/html"
+    asset: Optional[BinaryIO] = None
 
     if (url:=urlparse(self.path)).path == "/":
       with open(os.path.join(os.path.dirname(__file__), "index.html"), "rb") as f: ret = f.read()
@@ -152,23 +177,33 @@ class Handler(BaseHTTPRequestHandler):
       with open(os.path.join(os.path.dirname(__file__), "perfetto.html"), "rb") as f: ret = f.read()
     elif self.path.startswith("/assets/") and '/..' not in self.path:
       try:
-        with open(os.path.join(os.path.dirname(__file__), self.path.strip('/')), "rb") as f: ret = f.read()
+        asset = open(os.path.join(os.path.dirname(__file__), self.path.strip('/')), "rb")
         if url.path.endswith(".js"): content_type = "application/javascript"
         if url.path.endswith(".css"): content_type = "text/css"
-      except FileNotFoundError: status_code = 404
+      except (FileNotFoundError, IsADirectoryError): status_code = 404
     elif url.path == "/kernels":
       query = parse_qs(url.query)
-      if (qkernel:=query.get("kernel")) is not None:
-        g = get_details(*kernels[int(qkernel[0])][int(query["idx"][0])])
-        jret: Any = {**asdict(g), "uops": [pcall(str,x) for x in g.uops]}
-      else: jret = [list(map(lambda x:asdict(x[2]), v)) for v in kernels]
-      ret, content_type = json.dumps(jret).encode(), "application/json"
+      if (qkernel:=query.get("kernel")) is not None: ret = get_details_json(int(qkernel[0]), int(query["idx"][0]))
+      else: ret = json.dumps([list(map(lambda x:asdict(x[2]), v)) for v in kernels]).encode()
+      content_type = "application/json"
     elif url.path == "/get_profile" and perfetto_profile is not None: ret, content_type = perfetto_profile, "application/json"
     else: status_code = 404
 
     # send response
     self.send_response(status_code)
     self.send_header('Content-Type', content_type)
+    if asset is not None:
+      with asset as f:
+        self.send_header('Content-Length', str(size:=os.fstat(f.fileno()).st_size))
+        self.end_headers()
+        # NOTE: the kernel copies the file straight to the socket, fall back to reading it where there's no sendfile
+        if not hasattr(os, "sendfile"): return self.wfile.write(f.read())
+        offset = 0
+        while offset < size:
+          # NOTE: the file can be truncated after fstat, sendfile returns 0 at EOF
+          if (sent:=os.sendfile(self.wfile.fileno(), f.fileno(), offset, size-offset)) == 0: break
+          offset += sent
+      return
     self.send_header('Content-Length', str(len(ret)))
     self.end_headers()
     return self.wfile.write(ret)